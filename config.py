@@ -1,4 +1,5 @@
 import os
+import orjson
 from dotenv import load_dotenv
 
 # Get the absolute path of the directory where this file is located
@@ -17,8 +18,46 @@ class Config:
         'sqlite:///' + os.path.join(basedir, 'agrilink.db')
     
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        # Use orjson for JSON columns (e.g. Block.transaction_data)
+        'json_serializer': lambda obj: orjson.dumps(obj).decode('utf-8'),
+        'json_deserializer': orjson.loads,
+        # Room for every statement shape the app issues, so compiled SQL is
+        # reused instead of evicted (default is 500)
+        'query_cache_size': 1200,
+    }
+
+    # Keep server-database connections open between requests.
+    # Each gunicorn worker has its own pool, so size it to the worker's
+    # thread count (see gunicorn.conf.py) rather than to the whole machine.
+    if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS.update({
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 4)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 4)),
+            'pool_pre_ping': True,
+            'pool_recycle': 1800,
+        })
     
+    # Argon2id password hashing cost (argon2-cffi defaults). Each login holds
+    # ARGON2_MEMORY_COST KiB while hashing, so size it against worker threads.
+    ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST', 3))
+    ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST', 65536))
+    ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM', 4))
+
+    # Digest for new ledger blocks: 'sha256' or 'blake2b'
+    LEDGER_HASH = os.environ.get('LEDGER_HASH', 'sha256')
+
     # Configure the upload folder
     UPLOAD_FOLDER = os.path.join(basedir, 'static/uploads')
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+    # Threads per worker process writing uploads to disk in the background
+    UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+    # Compared against os.path.splitext() output, so the dot is included
+    ALLOWED_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg'})
+    # Upload filenames are random and never reused, so cache them for a year
+    UPLOAD_MAX_AGE = 31536000
+
+    # Behind nginx/Apache, hand file bodies to the front server (X-Sendfile)
+    # instead of streaming them through Python
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
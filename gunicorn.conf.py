@@ -0,0 +1,21 @@
+# gunicorn.conf.py
+# Loaded automatically by `gunicorn app:app` from the project root.
+
+import os
+import ssl
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Threaded workers: each thread reuses a pooled DB connection, so keep
+# `threads` in step with DB_POOL_SIZE in config.py
+worker_class = 'gthread'
+# `workers` is left to gunicorn: one process unless WEB_CONCURRENCY is set.
+# Each worker carries its own DB pool, upload threads and Argon2 memory, and
+# cpu_count() reports host cores rather than a container's CPU quota.
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+
+def on_starting(server):
+    # Ledger hashing goes through hashlib -> OpenSSL's libcrypto, which picks
+    # SHA-NI/AVX code paths at runtime; record which build is in use
+    server.log.info("Using %s", ssl.OPENSSL_VERSION)
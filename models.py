@@ -1,9 +1,14 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from flask_login import UserMixin
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import validates
 
 db = SQLAlchemy()
 
+# Order statuses whose price has been agreed and paid
+PAID_STATUSES = ('Paid', 'Awaiting Pickup', 'Shipped', 'Delivered')
+
 # --- Database Models ---
 
 class User(db.Model, UserMixin):
@@ -14,12 +19,14 @@ class User(db.Model, UserMixin):
     role = db.Column(db.String(20), nullable=False)  # 'farmer' or 'company'
     location = db.Column(db.String(100))
     
-    # Relationships
-    crops = db.relationship('Crop', backref='author', lazy=True)
-    sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='author', lazy=True)
-    received_messages = db.relationship('Message', foreign_keys='Message.recipient_id', backref='recipient', lazy=True)
-    orders_placed = db.relationship('Order', foreign_keys='Order.company_id', backref='company', lazy=True)
-    orders_received = db.relationship('Order', foreign_keys='Order.farmer_id', backref='farmer', lazy=True)
+    # Relationships. The one-to-many sides (here and on Crop, Order and
+    # LogisticsPartner) never load implicitly (lazy='raise'): query them or use
+    # selectinload/joinedload, so N+1 loops can't creep in
+    crops = db.relationship('Crop', back_populates='author', lazy='raise')
+    sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', back_populates='author', lazy='raise')
+    received_messages = db.relationship('Message', foreign_keys='Message.recipient_id', back_populates='recipient', lazy='raise')
+    orders_placed = db.relationship('Order', foreign_keys='Order.company_id', back_populates='company', lazy='raise')
+    orders_received = db.relationship('Order', foreign_keys='Order.farmer_id', back_populates='farmer', lazy='raise')
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -27,15 +34,28 @@ class User(db.Model, UserMixin):
 class Crop(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
+    name_lower = db.Column(db.String(100), nullable=False, index=True) # Kept in sync with name
     quantity = db.Column(db.Float, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    price = db.Column(db.Numeric(12, 2), nullable=False) # Per quintal; exact decimal money
     image_file = db.Column(db.String(100), nullable=False, default='default.jpg')
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # Leads ix_crop_farmer_date
     
     # Relationships
-    messages = db.relationship('Message', backref='crop', lazy=True)
-    orders = db.relationship('Order', backref='crop', lazy=True)
+    author = db.relationship('User', back_populates='crops')
+    messages = db.relationship('Message', back_populates='crop', lazy='raise')
+    orders = db.relationship('Order', back_populates='crop', lazy='raise')
+
+    # Serves the farmer dashboard's "my crops, newest first" listing
+    __table_args__ = (
+        db.Index('ix_crop_farmer_date', 'farmer_id', 'date_posted'),
+    )
+
+    @validates('name')
+    def validate_name(self, key, name):
+        # Case-insensitive lookups compare against name_lower so they can use its index
+        self.name_lower = name.lower()
+        return name
 
     def __repr__(self):
         return f'<Crop {self.name}>'
@@ -43,56 +63,122 @@ class Crop(db.Model):
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow) # Second column of ix_msg_crop_ts
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    # recipient_id and crop_id lead the composite indexes below
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     crop_id = db.Column(db.Integer, db.ForeignKey('crop.id'))
 
+    # Relationships
+    author = db.relationship('User', foreign_keys=[sender_id], back_populates='sent_messages')
+    recipient = db.relationship('User', foreign_keys=[recipient_id], back_populates='received_messages')
+    crop = db.relationship('Crop', back_populates='messages')
+
+    __table_args__ = (
+        # Chat history for a crop in timestamp order (the chat view's pair filter
+        # is applied to this range)
+        db.Index('ix_msg_crop_ts', 'crop_id', 'timestamp'),
+        # Covers the farmer dashboard's incoming-message scan, including the
+        # MAX(timestamp) per conversation, without touching the table
+        db.Index('ix_msg_recipient_crop_sender_ts', 'recipient_id', 'crop_id', 'sender_id', 'timestamp'),
+    )
+
     def __repr__(self):
         return f'<Message {self.body}>'
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # company_id and farmer_id lead the history indexes below
     company_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    crop_id = db.Column(db.Integer, db.ForeignKey('crop.id'), nullable=False)
+    crop_id = db.Column(db.Integer, db.ForeignKey('crop.id'), nullable=False, index=True)
     
     quantity = db.Column(db.Float, nullable=False)
-    total_price = db.Column(db.Float, nullable=False)
+    total_price = db.Column(db.Numeric(12, 2), nullable=False)
     status = db.Column(db.String(50), nullable=False, default='Pending Payment') # e.g., Pending Payment, Paid, Awaiting Pickup, Shipped, Delivered
     order_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     
     # Logistics
-    logistics_partner_id = db.Column(db.Integer, db.ForeignKey('logistics_partner.id'), nullable=True)
+    logistics_partner_id = db.Column(db.Integer, db.ForeignKey('logistics_partner.id'), nullable=True, index=True)
+
+    __table_args__ = (
+        # Partial index over paid orders only, for the price prediction aggregate.
+        # Carries the summed columns, and status for the re-checked IN filter,
+        # so the aggregate never touches the table.
+        db.Index(
+            'ix_order_paid_crop', 'crop_id', 'quantity', 'total_price', 'status',
+            postgresql_where=status.in_(PAID_STATUSES),
+            sqlite_where=status.in_(PAID_STATUSES)
+        ),
+        # Transaction history for each side, newest first, without a sort step
+        db.Index('ix_order_farmer_date', 'farmer_id', 'order_date'),
+        db.Index('ix_order_company_date', 'company_id', 'order_date'),
+    )
     
-    # Relationship
-    transaction = db.relationship('Transaction', backref='order', uselist=False, lazy=True)
-    block = db.relationship('Block', backref='order', uselist=False, lazy=True)
+    # Relationships
+    company = db.relationship('User', foreign_keys=[company_id], back_populates='orders_placed')
+    farmer = db.relationship('User', foreign_keys=[farmer_id], back_populates='orders_received')
+    crop = db.relationship('Crop', back_populates='orders')
+    logistics_partner = db.relationship('LogisticsPartner', back_populates='orders')
+    transaction = db.relationship('Transaction', back_populates='order', uselist=False, lazy='raise')
+    block = db.relationship('Block', back_populates='order', uselist=False, lazy='raise')
 
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), unique=True, nullable=False)
     payment_method = db.Column(db.String(50), nullable=False, default='Mock Payment')
     payment_status = db.Column(db.String(50), nullable=False, default='Completed')
     transaction_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    order = db.relationship('Order', back_populates='transaction')
+
 class LogisticsPartner(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     contact_email = db.Column(db.String(120), unique=True, nullable=False)
-    vehicles_available = db.Column(db.Integer, nullable=False)
+    vehicles_available = db.Column(db.SmallInteger, nullable=False)
     
     # Relationship
-    orders = db.relationship('Order', backref='logistics_partner', lazy=True)
+    orders = db.relationship('Order', back_populates='logistics_partner', lazy='raise')
 
 class Block(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), unique=True, nullable=False)
-    previous_hash = db.Column(db.String(64), nullable=False)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    transaction_data = db.Column(db.Text, nullable=False)
-    block_hash = db.Column(db.String(64), unique=True, nullable=False)
+    # Hashes are raw 32-byte digests; hex-encode only for display
+    previous_hash = db.Column(db.LargeBinary(32), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow) # See ix_block_ts_brin
+    # Native JSON (JSONB on Postgres) so reads come back as a dict
+    transaction_data = db.Column(db.JSON().with_variant(JSONB(), 'postgresql'), nullable=False)
+    # Exact bytes that were hashed (sorted-key JSON of transaction_data), so
+    # verification re-hashes them directly; NULL for blocks written before this column
+    canonical = db.Column(db.LargeBinary)
+    block_hash = db.Column(db.LargeBinary(32), unique=True, nullable=False)
+    # Digest used for block_hash (see LEDGER_HASH in config.py)
+    hash_algo = db.Column(db.String(16), nullable=False, default='sha256', server_default='sha256')
+
+    order = db.relationship('Order', back_populates='block')
+
+    # Blocks are append-only, so timestamp rises with physical row order: a BRIN
+    # index on Postgres is a tiny fraction of a btree's size for time-range scans.
+    # Other databases get a plain index.
+    __table_args__ = (
+        db.Index('ix_block_ts_brin', 'timestamp', postgresql_using='brin'),
+    )
+
+    @property
+    def hex_hash(self):
+        """block_hash as hex, for display."""
+        return self.block_hash.hex()
+
+    @property
+    def previous_hex_hash(self):
+        """previous_hash as hex, for display."""
+        return self.previous_hash.hex()
 
     def __repr__(self):
-        return f'<Block {self.block_hash}>'
+        return f'<Block {self.hex_hash}>'
 
+class LedgerHead(db.Model):
+    """Single row (id=1) holding the hash of the newest block in the ledger."""
+    id = db.Column(db.Integer, primary_key=True)
+    latest_hash = db.Column(db.LargeBinary(32), nullable=False)